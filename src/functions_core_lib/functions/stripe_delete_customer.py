@@ -1,9 +1,18 @@
+from typing import Optional
+
+from stripe import Customer
+
+from functions_core_lib.stripe.async_client import AsyncStripeClient
 from functions_core_lib.stripe.stripe_client import StripeClient, StripeError
-from functions_core_lib.stripe.types import CustomerApiResponse
+from functions_core_lib.stripe.types import (
+    EMAIL_REQUIRED_RESPONSE,
+    EMAILS_REQUIRED_RESPONSE,
+    CustomerApiResponse,
+)
 
 
-def delete_customer_by_email_function(data: dict, api_key: str) -> CustomerApiResponse:
-    """Handler for the create_customer Cloud Function"""
+def delete_customer_by_email_function(data: dict, api_key: Optional[str] = None) -> CustomerApiResponse:
+    """Handler for the delete_customer Cloud Function"""
     try:
         client = StripeClient(api_key=api_key)
 
@@ -11,24 +20,97 @@ def delete_customer_by_email_function(data: dict, api_key: str) -> CustomerApiRe
         email = data.get("email")
 
         if not email:
+            return EMAIL_REQUIRED_RESPONSE
+
+        resp = client.get_customers_by_email(email)  # returns a ListObject where "data" is a list
+        customer = next(iter(resp.auto_paging_iter()), None)
+
+        if customer is None:
+            return CustomerApiResponse(success=False, message=f"Customer with email {email} not found", status_code=404)
+
+        response = client.delete_customer(customer.id, email=customer.email)
+        if response.deleted:
             return CustomerApiResponse(
-                success=False, message="Email is required for deleting a customer", status_code=400
+                success=True, message=f"Customer with email {email} deleted successfully", status_code=200
             )
+        else:
+            return CustomerApiResponse(
+                success=False, message=f"Customer with email {email} could not be deleted", status_code=500
+            )
+    except StripeError as e:
+        # Handle Stripe errors
+        return CustomerApiResponse(success=False, message=str(e), error_code="STRIPE_ERROR", status_code=500)
 
-        resp = client.get_customers_by_email(email)  # returns a ListObject where "data" is a list
-        customer = resp["data"]
-
-        if customer and len(customer) > 0:
-            customer_id = customer["id"]
-            response = client.delete_customer(customer_id)
-            if response.deleted:
-                return CustomerApiResponse(
-                    success=True, message=f"Customer with email {email} deleted successfully", status_code=200
-                )
-            else:
-                return CustomerApiResponse(
-                    success=False, message=f"Customer with email {email} could not be deleted", status_code=500
-                )
+
+def delete_customers_by_emails_function(data: dict, api_key: Optional[str] = None) -> CustomerApiResponse:
+    """Handler for bulk deleting customers by email"""
+    try:
+        client = StripeClient(api_key=api_key)
+
+        emails = data.get("emails")
+
+        # A bare string would otherwise be searched one character at a time
+        if not emails or not isinstance(emails, list) or not all(email and isinstance(email, str) for email in emails):
+            return EMAILS_REQUIRED_RESPONSE
+
+        # One search request per chunk of emails instead of one lookup per email
+        customers = client.get_customers_by_emails(emails)
+
+        def delete(customer: Customer) -> bool:
+            try:
+                return client.delete_customer(customer.id, email=customer.email).deleted
+            except StripeError:
+                return False
+
+        # Deletes run concurrently but stay under Stripe's rate limit
+        results = client.bulk(delete, customers)
+        deleted = [customer.id for customer, ok in zip(customers, results) if ok]
+
+        if len(deleted) == len(customers):
+            return CustomerApiResponse(
+                success=True,
+                message=f"Deleted {len(deleted)} customers",
+                data={"deleted": deleted},
+                status_code=200,
+            )
+        else:
+            return CustomerApiResponse(
+                success=False,
+                message=f"Deleted {len(deleted)} of {len(customers)} customers",
+                data={"deleted": deleted},
+                status_code=500,
+            )
+    except StripeError as e:
+        # Handle Stripe errors
+        return CustomerApiResponse(success=False, message=str(e), error_code="STRIPE_ERROR", status_code=500)
+
+
+async def delete_customer_by_email_function_async(data: dict, api_key: Optional[str] = None) -> CustomerApiResponse:
+    """Async handler for the delete_customer Cloud Function"""
+    try:
+        client = AsyncStripeClient(api_key=api_key)
+
+        # Extract email from customer
+        email = data.get("email")
+
+        if not email:
+            return EMAIL_REQUIRED_RESPONSE
+
+        resp = await client.get_customers_by_email(email)  # returns a ListObject where "data" is a list
+        customers = resp["data"]
+
+        if not customers:
+            return CustomerApiResponse(success=False, message=f"Customer with email {email} not found", status_code=404)
+
+        response = await client.delete_customer(customers[0]["id"], email=customers[0]["email"])
+        if response.deleted:
+            return CustomerApiResponse(
+                success=True, message=f"Customer with email {email} deleted successfully", status_code=200
+            )
+        else:
+            return CustomerApiResponse(
+                success=False, message=f"Customer with email {email} could not be deleted", status_code=500
+            )
     except StripeError as e:
         # Handle Stripe errors
         return CustomerApiResponse(success=False, message=str(e), error_code="STRIPE_ERROR", status_code=500)
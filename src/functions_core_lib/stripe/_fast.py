@@ -0,0 +1,29 @@
+"""
+Hot path helpers kept to plain typed code so they can be compiled to a C extension with mypyc:
+
+    mypyc src/functions_core_lib/stripe/_fast.py
+
+A compiled module takes precedence over this file on import, the pure Python version is the fallback.
+"""
+
+
+def address_fields(address: dict[str, str]) -> tuple[str, str, str, str, str, str]:
+    """
+    Map an address from application format to StripeAddress fields.
+
+    Args:
+        address: Dictionary containing address details in application format
+
+    Returns:
+        City, country, line1, line2, postal_code and state, empty strings for missing values
+    """
+    # Field mapping from flutter app to what stripe wants, in StripeAddress field order
+    get = address.get
+    return (
+        get("city") or "",
+        get("country") or "",
+        get("street1") or "",
+        get("street2") or "",
+        get("zipCode") or "",
+        get("state") or "",
+    )
@@ -0,0 +1,479 @@
+import asyncio
+import importlib.util
+import ssl
+import stripe
+import threading
+import uuid
+from typing import AsyncGenerator, Awaitable, Callable, Iterable, Optional, TypeVar
+
+from stripe import Customer, HTTPClient, HTTPXClient, ListObject, PaymentMethod
+
+try:
+    import anyio
+    import httpx
+except ImportError:
+    anyio = None
+    httpx = None
+
+from functions_core_lib.stripe.concurrency import DEFAULT_MAX_CONCURRENCY, DEFAULT_MAX_PER_SECOND, AsyncRateLimiter
+from functions_core_lib.stripe.exceptions import StripeError
+from functions_core_lib.stripe.retry import retry_stripe_call
+from functions_core_lib.stripe.stripe_client import (
+    API_KEY_ENV_VAR,
+    _cache_namespace,
+    _invalidate_customer_cache,
+    _is_resource_missing,
+    _record_created_customer,
+    _resolve_api_key,
+    format_address,
+)
+from functions_core_lib.stripe.types import AddressDict
+from functions_core_lib.stripe.logger import core_logger
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+# HTTP/2 lets concurrent requests share one connection, it needs the h2 package from httpx[http2]
+_HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+_MAX_CONNECTIONS = 20
+
+
+# Lookups in flight per event loop, concurrent callers asking for the same thing share one request
+_INFLIGHT: dict[tuple, asyncio.Future] = {}
+
+
+async def _coalesce(key: tuple, fetch: Callable[[], Awaitable[R]]) -> R:
+    """
+    Await fetch, or the identical fetch another task already started.
+
+    Args:
+        key: Identifies the request, must include the client's cache namespace (API key and API base)
+        fetch: Coroutine function performing the request
+
+    Returns:
+        The shared result of fetch
+    """
+    loop = asyncio.get_running_loop()
+    key = (id(loop), *key)
+
+    future = _INFLIGHT.get(key)
+    if future is not None:
+        # Shielded so a cancelled follower does not cancel the request for everyone else
+        return await asyncio.shield(future)
+
+    future = loop.create_future()
+    _INFLIGHT[key] = future
+    try:
+        result = await fetch()
+    except asyncio.CancelledError:
+        future.cancel()
+        raise
+    except Exception as e:
+        future.set_exception(e)
+        # Mark the exception as retrieved so asyncio does not warn when nobody else was waiting
+        future.exception()
+        raise
+    else:
+        future.set_result(result)
+        return result
+    finally:
+        _INFLIGHT.pop(key, None)
+
+
+class PooledHTTPXClient(HTTPXClient):
+    """HTTPXClient with one bounded keep-alive pool per event loop that speaks HTTP/2 when available."""
+
+    def __init__(self, timeout: float = 80, **kwargs):
+        # HTTPXClient.__init__ would build an AsyncClient up front, pools are created per event loop on first use instead
+        HTTPClient.__init__(self, **kwargs)
+        if httpx is None:
+            raise ImportError("httpx is required for AsyncStripeClient, install the async extra")
+
+        self.httpx = httpx
+        self.anyio = anyio
+        self._client = None
+        self._timeout = timeout
+        self._verify = ssl.create_default_context(cafile=stripe.ca_bundle_path) if self._verify_ssl_certs else False
+        # httpx connections belong to the loop that opened them, each pool also holds the generator that closes it
+        self._pools: dict[asyncio.AbstractEventLoop, tuple["httpx.AsyncClient", AsyncGenerator[None, None]]] = {}
+
+    @property
+    def _client_async(self) -> "httpx.AsyncClient":
+        """The running event loop's pool, created on first use and closed when the loop shuts down."""
+        loop = asyncio.get_running_loop()
+        pool = self._pools.get(loop)
+        if pool is None:
+            client = httpx.AsyncClient(
+                verify=self._verify,
+                http2=_HTTP2_AVAILABLE,
+                limits=httpx.Limits(max_connections=_MAX_CONNECTIONS, max_keepalive_connections=_MAX_CONNECTIONS),
+            )
+            closer = self._close_at_shutdown(loop, client)
+            # Starting the generator registers it with the loop, shutdown_asyncgens (run by asyncio.run) finalizes it
+            try:
+                closer.asend(None).send(None)
+            except StopIteration:
+                pass
+            pool = self._pools[loop] = (client, closer)
+        return pool[0]
+
+    async def _close_at_shutdown(
+        self, loop: asyncio.AbstractEventLoop, client: "httpx.AsyncClient"
+    ) -> AsyncGenerator[None, None]:
+        """Suspend until the loop shuts down or close_async is awaited, then close the pool."""
+        try:
+            yield
+        finally:
+            if self._pools.get(loop, (None,))[0] is client:
+                del self._pools[loop]
+            await client.aclose()
+
+    async def close_async(self) -> None:
+        """Close the running event loop's pool now, the next request opens a new one."""
+        pool = self._pools.get(asyncio.get_running_loop())
+        if pool is not None:
+            await pool[1].aclose()
+
+
+# Shared by every AsyncStripeClient so warm instances reuse connections across invocations
+_HTTP_CLIENT: Optional[PooledHTTPXClient] = None
+_HTTP_CLIENT_LOCK = threading.Lock()
+
+
+def _get_http_client() -> PooledHTTPXClient:
+    """Return the shared pooled HTTP client, creating it on first use."""
+    global _HTTP_CLIENT
+
+    if _HTTP_CLIENT is None:
+        with _HTTP_CLIENT_LOCK:
+            if _HTTP_CLIENT is None:
+                _HTTP_CLIENT = PooledHTTPXClient()
+    return _HTTP_CLIENT
+
+
+async def close_http_client() -> None:
+    """Close the pooled connections of the running event loop, await it before the loop shuts down."""
+    if _HTTP_CLIENT is not None:
+        await _HTTP_CLIENT.close_async()
+
+
+class AsyncStripeClient:
+    def __init__(self, api_key: Optional[str] = None, api_base: Optional[str] = None):
+        """
+        Initialize an async Stripe client with the given API key.
+
+        Requests are sent through httpx, so the `async` extra must be installed.
+
+        Args:
+            api_key: The Stripe API key to use for all operations, read from STRIPE_API_KEY when not given
+            api_base: Base URL of the Stripe API, e.g. a local stripe-mock server; defaults to api.stripe.com
+
+        Raises:
+            StripeError: If no API key is given and STRIPE_API_KEY is not set
+        """
+        self.api_key = api_key or _resolve_api_key(API_KEY_ENV_VAR)
+        # Shares cache entries with StripeClient, so writes made here must invalidate them too.
+        # The cache client is synchronous, its round trips run in a worker thread to keep the loop free.
+        self._cache_namespace = _cache_namespace(self.api_key, api_base)
+        base_addresses = {"api": api_base} if api_base else {}
+        self.stripe = stripe.StripeClient(self.api_key, http_client=_get_http_client(), base_addresses=base_addresses)
+
+    ########################
+    # Create Methods
+    ########################
+    async def create_customer(
+        self,
+        email: str,
+        company_name: str,
+        phone: str,
+        address: Optional[AddressDict] = None,
+        idempotency_key: Optional[str] = None,
+    ) -> Customer:
+        """
+        Creates a new Stripe customer with the provided information.
+
+        Args:
+            email: Customer's email address
+            company_name: Name of the customer's company
+            phone: Customer's phone number
+            address: Dictionary containing address details
+            idempotency_key: Key that makes retries of this create safe, generated when not given
+
+        Returns:
+            Stripe customer object
+
+        Raises:
+            StripeError: If the customer creation fails
+        """
+        stripe_address = format_address(address)
+        params = {
+            "email": email,
+            "name": company_name,
+            "phone": phone,
+        }
+
+        # Only add address if it's not empty
+        if stripe_address is not None:
+            params["address"] = stripe_address.to_dict()
+        core_logger.debug("Creating Stripe customer with params: %s", params)
+
+        # Resent requests carry the same key so Stripe never creates the customer twice
+        if idempotency_key is None:
+            idempotency_key = str(uuid.uuid4())
+
+        customer = await self._create_customer(params, idempotency_key)
+        await asyncio.to_thread(_record_created_customer, self._cache_namespace, email)
+        return customer
+
+    @retry_stripe_call
+    async def _create_customer(self, params: dict, idempotency_key: str) -> Customer:
+        """Send the create request, every attempt reuses the same idempotency key."""
+        try:
+            return await self.stripe.customers.create_async(params, {"idempotency_key": idempotency_key})
+        except stripe.StripeError as e:
+            error_msg = f"Error when creating Stripe customer: {e}"
+            raise StripeError(error_msg, e) from e
+
+    ########################
+    # Read Methods
+    ########################
+
+    @retry_stripe_call
+    async def get_customer_by_id(self, customer_id: str) -> Optional[Customer]:
+        """
+        Retrieve a customer by their Stripe ID.
+
+        Args:
+            customer_id: The Stripe customer ID
+
+        Returns:
+            Stripe customer object, or None if no customer has this ID
+
+        Raises:
+            StripeError: If the customer retrieval fails
+        """
+        core_logger.info("Retrieving Stripe customer with ID %s", customer_id)
+        try:
+            return await _coalesce(
+                (self._cache_namespace, "customer", customer_id),
+                lambda: self.stripe.customers.retrieve_async(customer_id),
+            )
+        except stripe.StripeError as e:
+            if _is_resource_missing(e):
+                return None
+            error_msg = f"Error when retrieving Stripe customer {customer_id}: {e}"
+            raise StripeError(error_msg, e) from e
+
+    @retry_stripe_call
+    async def get_customers_by_email(self, email: str) -> ListObject[Customer]:
+        """
+        Find customers by email address.
+
+        Args:
+            email: The email address to search for
+
+        Returns:
+            List of matching Stripe customer objects
+
+        Raises:
+            StripeError: If the search fails
+        """
+        core_logger.info("Searching for Stripe customers with email %s", email)
+
+        params = {
+            "limit": 1,
+            "email": email,
+        }
+
+        try:
+            return await _coalesce(
+                (self._cache_namespace, "email", email), lambda: self.stripe.customers.list_async(params)
+            )
+        except stripe.StripeError as e:
+            error_msg = f"Error when searching for Stripe customers with email {email}: {e}"
+            raise StripeError(error_msg, e) from e
+
+    @retry_stripe_call
+    async def customer_exists_by_email(self, email: str) -> bool:
+        """
+        Check whether any customer uses the given email address.
+
+        Args:
+            email: The email address to check
+
+        Returns:
+            True if a customer with this email exists
+
+        Raises:
+            StripeError: If the lookup fails
+        """
+        core_logger.info("Checking for Stripe customers with email %s", email)
+
+        try:
+            customers = await self.stripe.customers.list_async({"email": email, "limit": 1})
+        except stripe.StripeError as e:
+            error_msg = f"Error when checking for Stripe customers with email {email}: {e}"
+            raise StripeError(error_msg, e) from e
+
+        return len(customers.data) > 0
+
+    @retry_stripe_call
+    async def list_customers(self, limit: int = 100, starting_after: Optional[str] = None) -> ListObject[Customer]:
+        """
+        List Stripe customers with pagination support.
+
+        Args:
+            limit: Maximum number of customers to return (default 100, max 100)
+            starting_after: Cursor for pagination (customer ID to start after)
+
+        Returns:
+            Paginated list of Stripe customer objects
+
+        Raises:
+            StripeError: If listing customers fails
+        """
+        core_logger.info("Listing Stripe customers with limit %s and starting_after %s", limit, starting_after)
+
+        params = {"limit": limit}
+        if starting_after:
+            params["starting_after"] = starting_after
+
+        try:
+            return await self.stripe.customers.list_async(params)
+        except stripe.StripeError as e:
+            error_msg = f"Error when listing Stripe customers: {e}"
+            raise StripeError(error_msg, e) from e
+
+    ########################
+    # Update Methods
+    ########################
+
+    @retry_stripe_call
+    async def update_customer(self, customer_id: str, update_params, previous_email: Optional[str] = None) -> Customer:
+        """
+        Update an existing Stripe customer.
+
+        Args:
+            customer_id: The Stripe customer ID
+            **update_params: Parameters to update on the customer
+            previous_email: Email before the update, looked up when the email changes and it is not given
+
+        Returns:
+            Updated Stripe customer object
+
+        Raises:
+            StripeError: If the customer update fails
+        """
+        core_logger.debug("Updating Stripe customer %s with params: %s", customer_id, update_params)
+
+        # Lookups cached under the old email must go too, or it would still look taken
+        if "email" in update_params and previous_email is None:
+            previous = await self.get_customer_by_id(customer_id)
+            previous_email = previous.email if previous is not None else None
+
+        try:
+            customer = await self.stripe.customers.update_async(customer_id, update_params)
+        except stripe.StripeError as e:
+            error_msg = f"Error when updating Stripe customer {customer_id}: {e}"
+            raise StripeError(error_msg, e) from e
+
+        await asyncio.to_thread(
+            _invalidate_customer_cache, self._cache_namespace, customer_id, customer.email, previous_email
+        )
+        return customer
+
+    # Additional payment method management
+    @retry_stripe_call
+    async def attach_payment_method(self, payment_method_id: str, customer_id: str) -> PaymentMethod:
+        """
+        Attach a payment method to a customer.
+
+        Args:
+            payment_method_id: The Stripe payment method ID
+            customer_id: The Stripe customer ID
+
+        Returns:
+            Stripe payment method object
+
+        Raises:
+            StripeError: If attaching the payment method fails
+        """
+        core_logger.info("Attaching payment method %s to customer %s", payment_method_id, customer_id)
+
+        try:
+            return await self.stripe.payment_methods.attach_async(payment_method_id, {"customer": customer_id})
+        except stripe.StripeError as e:
+            error_msg = f"Error attaching payment method {payment_method_id} to customer {customer_id}: {e}"
+            raise StripeError(error_msg, e) from e
+
+    ########################
+    # Delete Methods
+    ########################
+
+    @retry_stripe_call
+    async def delete_customer(self, customer_id: str, email: Optional[str] = None) -> Customer:
+        """
+        Delete a Stripe customer.
+
+        Args:
+            customer_id: The Stripe customer ID
+            email: Email of the customer, pass it so cached lookups by email are dropped as well
+
+        Returns:
+            Deletion confirmation from Stripe
+
+        Raises:
+            StripeError: If the customer deletion fails
+        """
+        core_logger.info("Deleting Stripe customer with ID %s", customer_id)
+
+        try:
+            deleted = await self.stripe.customers.delete_async(customer_id)
+        except stripe.StripeError as e:
+            error_msg = f"Error when deleting Stripe customer {customer_id}: {e}"
+            raise StripeError(error_msg, e) from e
+
+        await asyncio.to_thread(_invalidate_customer_cache, self._cache_namespace, customer_id, email)
+        return deleted
+
+    ########################
+    # Bulk Helpers
+    ########################
+
+    async def bulk(
+        self,
+        fn: Callable[[T], Awaitable[R]],
+        items: Iterable[T],
+        max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+        max_per_second: float = DEFAULT_MAX_PER_SECOND,
+    ) -> list[R]:
+        """
+        Await fn for every item concurrently while staying under Stripe's rate limit.
+
+        Test mode accounts allow far fewer requests per second, lower max_per_second there.
+        If any call fails the remaining ones are cancelled and the first error is raised.
+
+        Args:
+            fn: Coroutine function making one Stripe request per item, e.g. self.delete_customer
+            items: Items to pass to fn
+            max_concurrency: Maximum number of requests in flight at once
+            max_per_second: Maximum number of requests started per second
+
+        Returns:
+            Results of fn in the same order as items
+        """
+        semaphore = asyncio.Semaphore(max_concurrency)
+        limiter = AsyncRateLimiter(max_per_second)
+
+        async def run(item: T) -> R:
+            async with semaphore:
+                await limiter.acquire()
+                return await fn(item)
+
+        try:
+            async with asyncio.TaskGroup() as group:
+                tasks = [group.create_task(run(item)) for item in items]
+        except BaseExceptionGroup as errors:
+            # Callers handle StripeError, not groups, so surface the first failure as is
+            raise errors.exceptions[0]
+        return [task.result() for task in tasks]
@@ -0,0 +1,90 @@
+import json
+import os
+from typing import Any, Optional
+
+from functions_core_lib.stripe.logger import core_logger
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+# Caching is only enabled when the `cache` extra is installed and this variable points at a Redis instance
+REDIS_URL_ENV_VAR = "REDIS_URL"
+
+# An unreachable Redis must fail fast, callers fall back to Stripe on any cache error
+REDIS_SOCKET_TIMEOUT = 0.5
+
+_redis_client: Optional["redis.Redis"] = None
+
+
+def _get_redis() -> Optional["redis.Redis"]:
+    """Return the shared Redis connection, or None when caching is not configured."""
+    global _redis_client
+
+    if _redis_client is None and redis is not None:
+        url = os.environ.get(REDIS_URL_ENV_VAR)
+        if url:
+            _redis_client = redis.Redis.from_url(
+                url, socket_timeout=REDIS_SOCKET_TIMEOUT, socket_connect_timeout=REDIS_SOCKET_TIMEOUT
+            )
+    return _redis_client
+
+
+def get_generic_cache(key: str) -> Optional[Any]:
+    """
+    Read a JSON value from the cache.
+
+    Args:
+        key: Cache key to read
+
+    Returns:
+        The decoded value, or None on a miss or when caching is unavailable
+    """
+    client = _get_redis()
+    if client is None:
+        return None
+
+    try:
+        raw = client.get(key)
+    except redis.RedisError as e:
+        core_logger.warning("Error when reading cache key %s: %s", key, e)
+        return None
+
+    return json.loads(raw) if raw is not None else None
+
+
+def set_generic_cache(key: str, value: Any, ttl: int) -> None:
+    """
+    Store a JSON serializable value in the cache.
+
+    Args:
+        key: Cache key to write
+        value: Value to store, Stripe objects serialize as plain dicts
+        ttl: Expiry in seconds
+    """
+    client = _get_redis()
+    if client is None:
+        return
+
+    try:
+        client.set(key, json.dumps(value), ex=ttl)
+    except redis.RedisError as e:
+        core_logger.warning("Error when writing cache key %s: %s", key, e)
+
+
+def delete_generic_cache(*keys: str) -> None:
+    """
+    Remove keys from the cache.
+
+    Args:
+        *keys: Cache keys to delete
+    """
+    client = _get_redis()
+    if client is None or not keys:
+        return
+
+    try:
+        client.delete(*keys)
+    except redis.RedisError as e:
+        core_logger.warning("Error when deleting cache keys %s: %s", keys, e)
@@ -0,0 +1,42 @@
+import asyncio
+import threading
+import time
+
+# Stripe allows 100 requests per second in live mode, leave headroom for other traffic on the account
+DEFAULT_MAX_CONCURRENCY = 8
+DEFAULT_MAX_PER_SECOND = 80
+
+
+class RateLimiter:
+    """Thread safe limiter that spaces calls evenly to at most max_per_second."""
+
+    def __init__(self, max_per_second: float):
+        self._interval = 1 / max_per_second
+        self._next_slot = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """Block until the caller may start its next request."""
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self._interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class AsyncRateLimiter:
+    """Event loop limiter that spaces calls evenly to at most max_per_second."""
+
+    def __init__(self, max_per_second: float):
+        self._interval = 1 / max_per_second
+        self._next_slot = time.monotonic()
+
+    async def acquire(self) -> None:
+        """Wait until the caller may start its next request."""
+        # No await happens before the slot is claimed, so concurrent tasks cannot double book it
+        now = time.monotonic()
+        slot = max(now, self._next_slot)
+        self._next_slot = slot + self._interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
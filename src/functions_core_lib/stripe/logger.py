@@ -1,19 +1,5 @@
-from loguru import logger
+import logging
 
-import sys
-
-# Remove default Loguru handler to avoid duplicate logs
-logger.remove()
-
-# Configure Loguru to log to console and file
-logger.add(sys.stdout, format="{time} {level} {message}", level="INFO")
-
-
-# Optional: Customize logging for third-party libraries
-def intercept_loguru(record):
-    # Convert Loguru log records to standard logging format
-    return "{time} | {level} | {message}".format(**record)
-
-
-# Make the logger accessible throughout your library
-core_logger = logger
+# Library logger, applications attach their own handlers and choose the level
+core_logger = logging.getLogger("functions_core_lib.stripe")
+core_logger.addHandler(logging.NullHandler())
@@ -0,0 +1,49 @@
+import stripe
+from tenacity import RetryCallState, retry, retry_if_exception, stop_after_attempt, wait_exponential
+
+from functions_core_lib.stripe.exceptions import StripeError
+
+MAX_ATTEMPTS = 3
+MAX_WAIT_SECONDS = 8
+
+_wait_backoff = wait_exponential(multiplier=0.5, min=0.5, max=MAX_WAIT_SECONDS)
+
+
+def _response_header(exc: BaseException, name: str):
+    """Read a response header from the Stripe error wrapped by a StripeError."""
+    stripe_error = getattr(exc, "stripe_error", None)
+    headers = getattr(stripe_error, "headers", None)
+    return headers.get(name) if headers else None
+
+
+def _is_retryable(exc: BaseException) -> bool:
+    """Decide whether a failed call is transient and worth retrying."""
+    if not isinstance(exc, StripeError):
+        return False
+
+    # Stripe tells us explicitly when a retry would or would not help
+    should_retry = _response_header(exc, "Stripe-Should-Retry")
+    if should_retry is not None:
+        return should_retry == "true"
+
+    return isinstance(exc.stripe_error, (stripe.RateLimitError, stripe.APIConnectionError))
+
+
+def _wait(retry_state: RetryCallState) -> float:
+    """Honour Retry-After when Stripe sends it, otherwise back off exponentially."""
+    retry_after = _response_header(retry_state.outcome.exception(), "Retry-After")
+    if retry_after is not None:
+        try:
+            return min(float(retry_after), MAX_WAIT_SECONDS)
+        except ValueError:
+            pass
+    return _wait_backoff(retry_state)
+
+
+# Retries StripeClient / AsyncStripeClient methods on rate limits and connection errors
+retry_stripe_call = retry(
+    retry=retry_if_exception(_is_retryable),
+    wait=_wait,
+    stop=stop_after_attempt(MAX_ATTEMPTS),
+    reraise=True,
+)
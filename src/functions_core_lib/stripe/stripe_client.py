@@ -1,60 +1,240 @@
+import functools
+import hashlib
+import os
+import threading
 import stripe
-from typing import Optional
-
-from stripe import Customer, ListObject, PaymentMethod
-
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator, Optional, TypeVar, Union
+
+from requests import Session
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from stripe import Customer, ListObject, PaymentMethod, RequestsClient
+
+from functions_core_lib.stripe._fast import address_fields
+from functions_core_lib.stripe.cache import delete_generic_cache, get_generic_cache, set_generic_cache
+from functions_core_lib.stripe.concurrency import DEFAULT_MAX_CONCURRENCY, DEFAULT_MAX_PER_SECOND, RateLimiter
 from functions_core_lib.stripe.exceptions import StripeError
-from functions_core_lib.stripe.types import AddressDict, StripeAddressDict
+from functions_core_lib.stripe.retry import retry_stripe_call
+from functions_core_lib.stripe.types import AddressDict, StripeAddress, StripeAddressDict
 from functions_core_lib.stripe.logger import core_logger
 
+T = TypeVar("T")
+R = TypeVar("R")
+
+# Environment variable the API key is read from when callers do not pass one
+API_KEY_ENV_VAR = "STRIPE_API_KEY"
+
+# Underlying stripe clients are shared per API key so warm Cloud Function
+# instances reuse keep-alive connections instead of paying a TLS handshake per call
+_CLIENT_CACHE: dict[tuple[str, Optional[str]], stripe.StripeClient] = {}
+_CLIENT_CACHE_LOCK = threading.Lock()
+
+# Number of emails OR-ed together in a single search query, keeps queries under Stripe's length limit
+SEARCH_EMAILS_PER_QUERY = 10
+
+# Backslashes and quotes must be escaped inside quoted Search API values
+_SEARCH_ESCAPES = str.maketrans({"'": "\\'", "\\": "\\\\"})
+
+
+@functools.lru_cache(maxsize=1024)
+def _email_query(email: str) -> str:
+    """Build the Search API clause matching a single email."""
+    return f"email:'{email.translate(_SEARCH_ESCAPES)}'"
+
+
+# Stripe can close pooled connections at any time; creates are safe to resend because they carry an idempotency key.
+# Error statuses are left to retry_stripe_call, which understands Stripe's retry headers.
+_HTTP_RETRY = Retry(
+    total=3,
+    backoff_factor=0.5,
+    respect_retry_after_header=False,
+    allowed_methods=Retry.DEFAULT_ALLOWED_METHODS | {"POST"},
+)
+
+# Cache TTLs in seconds; email lookups expire sooner since customers can be created outside this lib
+CUSTOMER_CACHE_TTL = 60 * 60
+CUSTOMER_EMAIL_CACHE_TTL = 5 * 60
+EMAIL_SEEN_CACHE_TTL = 24 * 60 * 60
+
+
+@functools.lru_cache(maxsize=16)
+def _cache_namespace(api_key: str, api_base: Optional[str] = None) -> str:
+    """Cache key prefix that keeps accounts and test/live mode apart without putting the API key in Redis."""
+    return hashlib.sha256(f"{api_key}|{api_base or ''}".encode()).hexdigest()[:16]
+
+
+def _customer_cache_key(namespace: str, customer_id: str) -> str:
+    return f"stripe_customer:{namespace}:{customer_id}"
+
+
+def _customer_email_cache_key(namespace: str, email: str) -> str:
+    return f"stripe_customer_email:{namespace}:{email}"
+
+
+def _email_seen_cache_key(namespace: str, email: str) -> str:
+    return f"stripe_email_seen:{namespace}:{email}"
+
+
+def _invalidate_customer_cache(namespace: str, customer_id: str, *emails: Optional[str]) -> None:
+    """
+    Remove cached lookups for a customer after it has been written to.
+
+    Args:
+        namespace: Cache namespace of the client that wrote to the customer
+        customer_id: The Stripe customer ID
+        *emails: Emails the customer has or had, when known, e.g. both sides of an email change
+    """
+    keys = [_customer_cache_key(namespace, customer_id)]
+    emails = set(emails)
+
+    # The cached record knows the previous email when it was changed or is not known
+    cached = get_generic_cache(keys[0])
+    if cached is not None:
+        emails.add(cached.get("email"))
+
+    for e in emails:
+        if e:
+            keys.extend((_customer_email_cache_key(namespace, e), _email_seen_cache_key(namespace, e)))
+    delete_generic_cache(*keys)
+
+
+def _record_created_customer(namespace: str, email: str) -> None:
+    """Update the email caches after a customer with this email was created."""
+    # Drop any cached "no customer with this email" lookup
+    delete_generic_cache(_customer_email_cache_key(namespace, email))
+    set_generic_cache(_email_seen_cache_key(namespace, email), True, EMAIL_SEEN_CACHE_TTL)
+
 
-def format_address(address: Optional[AddressDict]) -> StripeAddressDict:
+def _new_http_client() -> RequestsClient:
+    """Build a requests based HTTP client backed by a pooled session."""
+    session = Session()
+    session.mount("https://", HTTPAdapter(pool_connections=10, pool_maxsize=20, max_retries=_HTTP_RETRY))
+    return RequestsClient(session=session)
+
+
+@functools.lru_cache(maxsize=4)
+def _resolve_api_key(env_var: str) -> str:
+    """
+    Read the Stripe API key from the environment once per process.
+
+    Args:
+        env_var: Name of the environment variable holding the key
+
+    Returns:
+        The Stripe API key
+
+    Raises:
+        StripeError: If the environment variable is not set
+    """
+    try:
+        return os.environ[env_var]
+    except KeyError as e:
+        raise StripeError(f"{env_var} environment variable not set", e) from e
+
+
+def _is_resource_missing(error: stripe.StripeError) -> bool:
+    """Whether Stripe rejected the request because the requested object does not exist."""
+    return isinstance(error, stripe.InvalidRequestError) and error.code == "resource_missing"
+
+
+def _get_stripe_client(api_key: str, api_base: Optional[str] = None) -> stripe.StripeClient:
+    """
+    Return the shared stripe client for the given API key, creating it on first use.
+
+    Args:
+        api_key: The Stripe API key the client is bound to
+        api_base: Base URL of the Stripe API, defaults to api.stripe.com
+
+    Returns:
+        Cached stripe.StripeClient instance
+    """
+    cache_key = (api_key, api_base)
+    client = _CLIENT_CACHE.get(cache_key)
+    if client is None:
+        with _CLIENT_CACHE_LOCK:
+            client = _CLIENT_CACHE.get(cache_key)
+            if client is None:
+                base_addresses = {"api": api_base} if api_base else {}
+                client = stripe.StripeClient(api_key, http_client=_new_http_client(), base_addresses=base_addresses)
+                _CLIENT_CACHE[cache_key] = client
+    return client
+
+
+_STRIPE_ADDRESS_KEYS = frozenset(StripeAddress._fields)
+# Keys that only exist in Stripe format, city, country and state are named the same in both
+_STRIPE_ONLY_ADDRESS_KEYS = frozenset({"line1", "line2", "postal_code"})
+
+
+def format_address(address: Optional[Union[AddressDict, StripeAddressDict]]) -> Optional[StripeAddress]:
     """
     Format address from application format to Stripe format.
 
+    Addresses that are already in Stripe format are passed through instead of losing their fields.
+
     Args:
-        address: Dictionary containing address details in application format
+        address: Dictionary containing address details in application or Stripe format
 
     Returns:
-        Dictionary with address details formatted for Stripe API
+        StripeAddress with address details formatted for Stripe API, use to_dict() for the API params.
+        None when the address has no non-empty fields.
     """
     if not address:
-        return {}
+        return None
 
-    core_logger.info(f"Formatting address: {address}")
+    # JSON input can carry numbers, e.g. a numeric zipCode, and the compiled address_fields only accepts strings.
+    # Only such addresses are copied, falsy values are dropped like missing ones.
+    if not all(isinstance(v, str) for v in address.values()):
+        address = {k: v if isinstance(v, str) else str(v) for k, v in address.items() if v}
 
-    # Field mapping from flutter app to what stripe wants
-    field_mapping = {
-        "city": "city",
-        "country": "country",
-        "street1": "line1",
-        "street2": "line2",  # Fixed typo here
-        "zipCode": "postal_code",
-        "state": "state",
-    }
+    keys = address.keys()
+    if keys <= _STRIPE_ADDRESS_KEYS and not keys.isdisjoint(_STRIPE_ONLY_ADDRESS_KEYS):
+        get = address.get
+        fields = tuple(get(k) or "" for k in StripeAddress._fields)
+    else:
+        fields = address_fields(address)
 
-    return {
-        field_mapping[k]: v for k, v in address.items() if k in field_mapping and v
-    }  # Only include non-empty values
+    return StripeAddress._make(fields) if any(fields) else None
 
 
 class StripeClient:
-    def __init__(self, api_key: str):
+    def __init__(
+        self, api_key: Optional[str] = None, api_base: Optional[str] = None, http_session: Optional[Session] = None
+    ):
         """
         Initialize a Stripe client with the given API key.
 
         Args:
-            api_key: The Stripe API key to use for all operations
+            api_key: The Stripe API key to use for all operations, read from STRIPE_API_KEY when not given
+            api_base: Base URL of the Stripe API, e.g. a local stripe-mock server; defaults to api.stripe.com
+            http_session: requests Session to send requests through, uses the shared pooled session when not given
+
+        Raises:
+            StripeError: If no API key is given and STRIPE_API_KEY is not set
         """
-        self.api_key = api_key
-        # Initialize a client instance instead of setting global API key
-        self.stripe = stripe.StripeClient(api_key)
+        self.api_key = api_key or _resolve_api_key(API_KEY_ENV_VAR)
+        self._cache_namespace = _cache_namespace(self.api_key, api_base)
+        if http_session is None:
+            # Reuse the cached client instance instead of setting global API key
+            self.stripe = _get_stripe_client(self.api_key, api_base)
+        else:
+            # A caller supplied session is never shared through the client cache
+            base_addresses = {"api": api_base} if api_base else {}
+            self.stripe = stripe.StripeClient(
+                self.api_key, http_client=RequestsClient(session=http_session), base_addresses=base_addresses
+            )
 
     ########################
     # Create Methods
     ########################
     def create_customer(
-        self, email: str, company_name: str, phone: str, address: Optional[AddressDict] = None
+        self,
+        email: str,
+        company_name: str,
+        phone: str,
+        address: Optional[AddressDict] = None,
+        idempotency_key: Optional[str] = None,
     ) -> Customer:
         """
         Creates a new Stripe customer with the provided information.
@@ -64,6 +244,7 @@ class StripeClient:
             company_name: Name of the customer's company
             phone: Customer's phone number
             address: Dictionary containing address details
+            idempotency_key: Key that makes retries of this create safe, generated when not given
 
         Returns:
             Stripe customer object
@@ -79,21 +260,33 @@ class StripeClient:
         }
 
         # Only add address if it's not empty
-        if stripe_address:
-            params["address"] = stripe_address
-        core_logger.info(f"Creating Stripe customer with params: {params}")
+        if stripe_address is not None:
+            params["address"] = stripe_address.to_dict()
+        core_logger.debug("Creating Stripe customer with params: %s", params)
+
+        # Resent requests carry the same key so Stripe never creates the customer twice
+        if idempotency_key is None:
+            idempotency_key = str(uuid.uuid4())
 
+        customer = self._create_customer(params, idempotency_key)
+        _record_created_customer(self._cache_namespace, email)
+        return customer
+
+    @retry_stripe_call
+    def _create_customer(self, params: dict, idempotency_key: str) -> Customer:
+        """Send the create request, every attempt reuses the same idempotency key."""
         try:
-            return self.stripe.customers.create(params)
-        except Exception as e:
+            return self.stripe.customers.create(params, {"idempotency_key": idempotency_key})
+        except stripe.StripeError as e:
             error_msg = f"Error when creating Stripe customer: {e}"
-            raise StripeError(error_msg, e)
+            raise StripeError(error_msg, e) from e
 
     ########################
     # Read Methods
     ########################
 
-    def get_customer_by_id(self, customer_id: str) -> Customer:
+    @retry_stripe_call
+    def get_customer_by_id(self, customer_id: str) -> Optional[Customer]:
         """
         Retrieve a customer by their Stripe ID.
 
@@ -101,18 +294,29 @@ class StripeClient:
             customer_id: The Stripe customer ID
 
         Returns:
-            Stripe customer object
+            Stripe customer object, or None if no customer has this ID
 
         Raises:
             StripeError: If the customer retrieval fails
         """
-        core_logger.info(f"Retrieving Stripe customer with ID {customer_id}")
+        cache_key = _customer_cache_key(self._cache_namespace, customer_id)
+        cached = get_generic_cache(cache_key)
+        if cached is not None:
+            return Customer.construct_from(cached, self.api_key)
+
+        core_logger.info("Retrieving Stripe customer with ID %s", customer_id)
         try:
-            return self.stripe.customers.retrieve(customer_id)
-        except Exception as e:
+            customer = self.stripe.customers.retrieve(customer_id)
+        except stripe.StripeError as e:
+            if _is_resource_missing(e):
+                return None
             error_msg = f"Error when retrieving Stripe customer {customer_id}: {e}"
-            raise StripeError(error_msg, e)
+            raise StripeError(error_msg, e) from e
 
+        set_generic_cache(cache_key, customer, CUSTOMER_CACHE_TTL)
+        return customer
+
+    @retry_stripe_call
     def get_customers_by_email(self, email: str) -> ListObject[Customer]:
         """
         Find customers by email address.
@@ -126,7 +330,12 @@ class StripeClient:
         Raises:
             StripeError: If the search fails
         """
-        core_logger.info(f"Searching for Stripe customers with email {email}")
+        cache_key = _customer_email_cache_key(self._cache_namespace, email)
+        cached = get_generic_cache(cache_key)
+        if cached is not None:
+            return ListObject.construct_from(cached, self.api_key)
+
+        core_logger.info("Searching for Stripe customers with email %s", email)
 
         params = {
             "limit": 1,
@@ -134,11 +343,106 @@ class StripeClient:
         }
 
         try:
-            return self.stripe.customers.list(params)
-        except Exception as e:
+            customers = self.stripe.customers.list(params)
+        except stripe.StripeError as e:
             error_msg = f"Error when searching for Stripe customers with email {email}: {e}"
-            raise StripeError(error_msg, e)
+            raise StripeError(error_msg, e) from e
+
+        set_generic_cache(cache_key, customers, CUSTOMER_EMAIL_CACHE_TTL)
+        return customers
+
+    def iter_customers_by_email(self, email: str) -> Iterator[Customer]:
+        """
+        Lazily iterate over every customer with the given email address.
+
+        Pages are only fetched from Stripe as the iterator is consumed.
+
+        Args:
+            email: The email address to search for
+
+        Yields:
+            Matching Stripe customer objects
+
+        Raises:
+            StripeError: If fetching a page fails
+        """
+        core_logger.info("Iterating Stripe customers with email %s", email)
+
+        try:
+            yield from self.stripe.customers.search({"query": _email_query(email)}).auto_paging_iter()
+        except stripe.StripeError as e:
+            error_msg = f"Error when iterating Stripe customers with email {email}: {e}"
+            raise StripeError(error_msg, e) from e
+
+    def get_customers_by_emails(self, emails: list[str]) -> list[Customer]:
+        """
+        Find customers for many email addresses with as few requests as possible.
+
+        Uses the Search API, which is eventually consistent, so customers created in the
+        last minute may be missing. Use get_customers_by_email for single lookups.
+
+        Args:
+            emails: The email addresses to search for
+
+        Returns:
+            All Stripe customer objects matching any of the emails, each customer once
+
+        Raises:
+            StripeError: If the search fails
+        """
+        # Duplicate emails would otherwise return the same customer more than once
+        emails = list(dict.fromkeys(emails))
+        core_logger.info("Searching for Stripe customers with %s emails", len(emails))
+
+        customers = {}
+        for i in range(0, len(emails), SEARCH_EMAILS_PER_QUERY):
+            chunk = emails[i : i + SEARCH_EMAILS_PER_QUERY]
+            for customer in self._search_customers(" OR ".join(map(_email_query, chunk))):
+                customers.setdefault(customer.id, customer)
+
+        return list(customers.values())
+
+    @retry_stripe_call
+    def _search_customers(self, query: str) -> list[Customer]:
+        """Run one search and collect every page, retried on its own so earlier chunks are not searched again."""
+        try:
+            return list(self.stripe.customers.search({"query": query, "limit": 100}).auto_paging_iter())
+        except stripe.StripeError as e:
+            error_msg = f"Error when searching for Stripe customers by emails: {e}"
+            raise StripeError(error_msg, e) from e
+
+    @retry_stripe_call
+    def customer_exists_by_email(self, email: str) -> bool:
+        """
+        Check whether any customer uses the given email address.
+
+        Args:
+            email: The email address to check
+
+        Returns:
+            True if a customer with this email exists
 
+        Raises:
+            StripeError: If the lookup fails
+        """
+        cache_key = _email_seen_cache_key(self._cache_namespace, email)
+        cached = get_generic_cache(cache_key)
+        if cached is not None:
+            return cached
+
+        core_logger.info("Checking for Stripe customers with email %s", email)
+
+        try:
+            exists = len(self.stripe.customers.list({"email": email, "limit": 1}).data) > 0
+        except stripe.StripeError as e:
+            error_msg = f"Error when checking for Stripe customers with email {email}: {e}"
+            raise StripeError(error_msg, e) from e
+
+        # Misses expire quickly since customers can also be created outside this lib
+        set_generic_cache(cache_key, exists, EMAIL_SEEN_CACHE_TTL if exists else CUSTOMER_EMAIL_CACHE_TTL)
+        return exists
+
+    @retry_stripe_call
     def list_customers(self, limit: int = 100, starting_after: Optional[str] = None) -> ListObject[Customer]:
         """
         List Stripe customers with pagination support.
@@ -153,7 +457,7 @@ class StripeClient:
         Raises:
             StripeError: If listing customers fails
         """
-        core_logger.info(f"Listing Stripe customers with limit {limit} and starting_after {starting_after}")
+        core_logger.info("Listing Stripe customers with limit %s and starting_after %s", limit, starting_after)
 
         params = {"limit": limit}
         if starting_after:
@@ -161,21 +465,23 @@ class StripeClient:
 
         try:
             return self.stripe.customers.list(params)
-        except Exception as e:
+        except stripe.StripeError as e:
             error_msg = f"Error when listing Stripe customers: {e}"
-            raise StripeError(error_msg, e)
+            raise StripeError(error_msg, e) from e
 
     ########################
     # Update Methods
     ########################
 
-    def update_customer(self, customer_id: str, update_params) -> Customer:
+    @retry_stripe_call
+    def update_customer(self, customer_id: str, update_params, previous_email: Optional[str] = None) -> Customer:
         """
         Update an existing Stripe customer.
 
         Args:
             customer_id: The Stripe customer ID
             **update_params: Parameters to update on the customer
+            previous_email: Email before the update, looked up when the email changes and it is not given
 
         Returns:
             Updated Stripe customer object
@@ -183,15 +489,24 @@ class StripeClient:
         Raises:
             StripeError: If the customer update fails
         """
-        core_logger.info(f"Updating Stripe customer {customer_id} with params: {update_params}")
+        core_logger.debug("Updating Stripe customer %s with params: %s", customer_id, update_params)
+
+        # Lookups cached under the old email must go too, or it would still look taken
+        if "email" in update_params and previous_email is None:
+            previous = self.get_customer_by_id(customer_id)
+            previous_email = previous.email if previous is not None else None
 
         try:
-            return self.stripe.customers.update(customer_id, update_params)
-        except Exception as e:
+            customer = self.stripe.customers.update(customer_id, update_params)
+        except stripe.StripeError as e:
             error_msg = f"Error when updating Stripe customer {customer_id}: {e}"
-            raise StripeError(error_msg, e)
+            raise StripeError(error_msg, e) from e
+
+        _invalidate_customer_cache(self._cache_namespace, customer_id, customer.email, previous_email)
+        return customer
 
     # Additional payment method management
+    @retry_stripe_call
     def attach_payment_method(self, payment_method_id: str, customer_id: str) -> PaymentMethod:
         """
         Attach a payment method to a customer.
@@ -206,24 +521,26 @@ class StripeClient:
         Raises:
             StripeError: If attaching the payment method fails
         """
-        core_logger.info(f"Attaching payment method {payment_method_id} to customer {customer_id}")
+        core_logger.info("Attaching payment method %s to customer %s", payment_method_id, customer_id)
 
         try:
-            return self.stripe.payment_methods.attach(payment_method_id, customer=customer_id)
-        except Exception as e:
+            return self.stripe.payment_methods.attach(payment_method_id, {"customer": customer_id})
+        except stripe.StripeError as e:
             error_msg = f"Error attaching payment method {payment_method_id} to customer {customer_id}: {e}"
-            raise StripeError(error_msg, e)
+            raise StripeError(error_msg, e) from e
 
     ########################
     # Delete Methods
     ########################
 
-    def delete_customer(self, customer_id: str) -> Customer:
+    @retry_stripe_call
+    def delete_customer(self, customer_id: str, email: Optional[str] = None) -> Customer:
         """
         Delete a Stripe customer.
 
         Args:
             customer_id: The Stripe customer ID
+            email: Email of the customer, pass it so cached lookups by email are dropped as well
 
         Returns:
             Deletion confirmation from Stripe
@@ -231,10 +548,47 @@ class StripeClient:
         Raises:
             StripeError: If the customer deletion fails
         """
-        core_logger.info(f"Deleting Stripe customer with ID {customer_id}")
+        core_logger.info("Deleting Stripe customer with ID %s", customer_id)
 
         try:
-            return self.stripe.customers.delete(customer_id)
-        except Exception as e:
+            deleted = self.stripe.customers.delete(customer_id)
+        except stripe.StripeError as e:
             error_msg = f"Error when deleting Stripe customer {customer_id}: {e}"
-            raise StripeError(error_msg, e)
+            raise StripeError(error_msg, e) from e
+
+        _invalidate_customer_cache(self._cache_namespace, customer_id, email)
+        return deleted
+
+    ########################
+    # Bulk Helpers
+    ########################
+
+    def bulk(
+        self,
+        fn: Callable[[T], R],
+        items: Iterable[T],
+        max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+        max_per_second: float = DEFAULT_MAX_PER_SECOND,
+    ) -> list[R]:
+        """
+        Apply fn to every item concurrently while staying under Stripe's rate limit.
+
+        Test mode accounts allow far fewer requests per second, lower max_per_second there.
+
+        Args:
+            fn: Callable making one Stripe request per item, e.g. self.delete_customer
+            items: Items to pass to fn
+            max_concurrency: Maximum number of requests in flight at once
+            max_per_second: Maximum number of requests started per second
+
+        Returns:
+            Results of fn in the same order as items
+        """
+        limiter = RateLimiter(max_per_second)
+
+        def run(item: T) -> R:
+            limiter.acquire()
+            return fn(item)
+
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            return list(executor.map(run, items))
@@ -1,5 +1,16 @@
+import orjson
 from dataclasses import dataclass
-from typing import Any, Optional, TypedDict
+from stripe import StripeObject
+from typing import Any, NamedTuple, Optional, TypedDict
+
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+
+def _stripe_default(obj: Any) -> Any:
+    """Serialize values orjson does not handle natively"""
+    if isinstance(obj, StripeObject):
+        return dict(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
 
 
 class AddressDict(TypedDict, total=False):
@@ -20,7 +31,22 @@ class StripeAddressDict(TypedDict, total=False):
     state: str
 
 
-@dataclass
+class StripeAddress(NamedTuple):
+    """Address in Stripe format, empty strings mark missing fields"""
+
+    city: str = ""
+    country: str = ""
+    line1: str = ""
+    line2: str = ""
+    postal_code: str = ""
+    state: str = ""
+
+    def to_dict(self) -> StripeAddressDict:
+        """Convert to the params dict sent to the Stripe API, dropping empty fields"""
+        return {k: v for k, v in self._asdict().items() if v}
+
+
+@dataclass(slots=True, frozen=True)
 class CustomerApiResponse:
     success: bool
     message: str
@@ -31,11 +57,27 @@ class CustomerApiResponse:
     def to_response(self) -> tuple[dict[str, Any], int]:
         """Convert to response tuple for Cloud Functions"""
         response_data = {"success": self.success, "message": self.message}
-
         if self.data is not None:
             response_data["data"] = self.data
-
         if self.error_code is not None:
             response_data["error_code"] = self.error_code
-
         return response_data, self.status_code
+
+    def to_json_bytes(self) -> tuple[bytes, int]:
+        """Convert to a serialized JSON body and status code"""
+        response_data, status_code = self.to_response()
+        return orjson.dumps(response_data, default=_stripe_default), status_code
+
+    def to_http_response(self) -> tuple[bytes, int, dict[str, str]]:
+        """Convert to a (body, status, headers) tuple Cloud Functions can return as is"""
+        body, status_code = self.to_json_bytes()
+        return body, status_code, dict(JSON_HEADERS)
+
+
+# Responses are immutable, so handlers share these instead of building a new one per call
+EMAIL_REQUIRED_RESPONSE = CustomerApiResponse(
+    success=False, message="Email is required for deleting a customer", status_code=400
+)
+EMAILS_REQUIRED_RESPONSE = CustomerApiResponse(
+    success=False, message="Emails are required for deleting customers", status_code=400
+)
@@ -0,0 +1,56 @@
+import json
+import os
+
+import pytest
+from dotenv import load_dotenv
+
+from functions_core_lib.stripe.stripe_client import StripeClient
+
+# Written by the persistent_customer fixture when the suite runs under pytest-xdist
+PERSISTENT_CUSTOMER_FILE = "persistent_customer.json"
+
+
+def pytest_addoption(parser):
+    parser.addoption(
+        "--live-stripe",
+        action="store_true",
+        default=False,
+        help="Run client tests against the real Stripe test API instead of stripe-mock",
+    )
+    parser.addoption(
+        "--use-requests-cache",
+        action="store_true",
+        default=False,
+        help="Replay Stripe GET responses from .cache/stripe-cache.sqlite, needs requests-cache",
+    )
+
+
+def pytest_collection_modifyitems(config, items):
+    """Skip tests that need Stripe to keep state between requests unless running against the real API."""
+    if config.getoption("--live-stripe"):
+        return
+
+    skip_live = pytest.mark.skip(reason="needs --live-stripe, stripe-mock does not keep state between requests")
+    for item in items:
+        if "live_stripe" in item.keywords:
+            item.add_marker(skip_live)
+
+
+def pytest_sessionfinish(session):
+    """Delete the customer the xdist workers shared, this runs on the controller once every worker is done."""
+    if hasattr(session.config, "workerinput") or not session.config.getoption("--live-stripe"):
+        return
+    # STRIPE_DEBUG_CACHE=1 keeps the customer for the next run, as long as pytest's cache is available to hold it
+    if os.environ.get("STRIPE_DEBUG_CACHE") == "1" and getattr(session.config, "cache", None) is not None:
+        return
+
+    shared_file = session.config._tmp_path_factory.getbasetemp() / PERSISTENT_CUSTOMER_FILE
+    if not shared_file.is_file():
+        return
+
+    customer_id = json.loads(shared_file.read_text())["id"]
+    load_dotenv()
+    try:
+        StripeClient(api_key=os.environ["STRIPE_TEST_API_KEY"]).delete_customer(customer_id)
+    except Exception as e:
+        print(f"Warning: Failed to delete persistent test customer {customer_id}: {e}")
@@ -1,26 +1,187 @@
+import asyncio
+import contextlib
+import copy
+import functools
+import json
 import os
+import pickle
+import re
 import pytest
+import requests
+import shutil
+import socket
+import stripe
+import subprocess
+import threading
 import time
-import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Callable, ContextManager, NamedTuple, Optional
+from urllib.parse import parse_qsl, urlsplit
 
 from dotenv import load_dotenv
-from functions_core_lib.stripe.stripe_client import StripeClient, format_address
+from filelock import FileLock
+from requests.adapters import HTTPAdapter
+from functions_core_lib.stripe import async_client, cache, concurrency
+from functions_core_lib.stripe.async_client import AsyncStripeClient, _coalesce, close_http_client
+from functions_core_lib.functions.stripe_create_customer import (
+    create_customer_function,
+    create_customer_function_async,
+)
+from functions_core_lib.functions.stripe_delete_customer import (
+    delete_customer_by_email_function,
+    delete_customer_by_email_function_async,
+    delete_customers_by_emails_function,
+)
+from functions_core_lib.stripe.stripe_client import (
+    SEARCH_EMAILS_PER_QUERY,
+    StripeClient,
+    _cache_namespace,
+    _customer_cache_key,
+    _customer_email_cache_key,
+    _email_query,
+    _email_seen_cache_key,
+    _resolve_api_key,
+    format_address,
+)
 from functions_core_lib.stripe.exceptions import StripeError
-
-# Load environment variables from .env file
-load_dotenv()
+from functions_core_lib.stripe.retry import retry_stripe_call
+from functions_core_lib.stripe.types import EMAILS_REQUIRED_RESPONSE, CustomerApiResponse
+from secrets import token_hex
 
 
 def generate_unique_email() -> str:
     """Generate a unique email for testing."""
-    unique_id = uuid.uuid4().hex[:4]
-    return f"test{unique_id}@example.com"
+    return f"test{token_hex(2)}@example.com"
 
 
 def generate_unique_company_name() -> str:
     """Generate a unique company name for testing."""
-    unique_id = uuid.uuid4().hex[:8]
-    return f"Test Company {unique_id}"
+    return f"Test Company {token_hex(4)}"
+
+
+# Address in application format as used by test_customer_data, and its Stripe format
+ADDR_INPUT = {
+    "city": "San Francisco",
+    "country": "US",
+    "street1": "123 Market St",
+    "street2": "Suite 456",
+    "zipCode": "94107",
+    "state": "CA",
+}
+ADDR_EXPECTED = {
+    "city": "San Francisco",
+    "country": "US",
+    "line1": "123 Market St",
+    "line2": "Suite 456",
+    "postal_code": "94107",
+    "state": "CA",
+}
+
+# Small page for the pagination test, finding a specific customer is left to the email lookup
+LIST_PAGE_SIZE = 3
+
+# Wording Stripe uses when a customer does not exist
+_NOT_FOUND_RE = re.compile(r"no such customer|could not be found", re.IGNORECASE)
+
+STRIPE_MOCK_PORT = 12111
+HTTP_POOL_SIZE = 16
+
+# Responses replayed by --use-requests-cache expire after 12 hours
+REQUESTS_CACHE_PATH = ".cache/stripe-cache.sqlite"
+REQUESTS_CACHE_EXPIRE_SECONDS = 43200
+
+# Shared between pytest-xdist workers through the base temp directory, conftest.py deletes the customer it names
+PERSISTENT_CUSTOMER_FILE = "persistent_customer.json"
+
+# With STRIPE_DEBUG_CACHE=1 the persistent customer is kept and reused by later runs
+DEBUG_CACHE_ENV_VAR = "STRIPE_DEBUG_CACHE"
+# Stored under pytest's cache directory in the rootdir, wherever pytest is started from
+DEBUG_CACHE_DIR = "stripe_debug"
+DEBUG_CACHE_FILE = "persistent_customer.pkl"
+
+
+def debug_cache_enabled() -> bool:
+    """Whether the persistent customer should survive the session for the next run."""
+    return os.environ.get(DEBUG_CACHE_ENV_VAR) == "1"
+
+
+def uncached(http_session: Optional[requests.Session]) -> ContextManager:
+    """Bypass --use-requests-cache for requests that must see Stripe's current state."""
+    cache_disabled = getattr(http_session, "cache_disabled", None)
+    return cache_disabled() if cache_disabled is not None else contextlib.nullcontext()
+
+
+def debug_caching(create: Callable[[StripeClient], dict]) -> Callable[..., dict]:
+    """Reuse the customer pickled by a previous run when debug caching is on and Stripe still has it."""
+
+    @functools.wraps(create)
+    def wrapper(
+        stripe_client: StripeClient, http_session: Optional[requests.Session] = None, cache_path: Optional[Path] = None
+    ) -> dict:
+        if cache_path is None:
+            return create(stripe_client)
+
+        if cache_path.is_file():
+            customer = pickle.loads(cache_path.read_bytes())
+            # A replayed response would still show a customer that was deleted on Stripe since
+            with uncached(http_session):
+                existing = stripe_client.get_customer_by_id(customer["id"])
+            # Retrieving a deleted customer still succeeds, it just comes back flagged as deleted
+            if existing is not None and not existing.get("deleted"):
+                return customer
+
+        customer = create(stripe_client)
+        cache_path.write_bytes(pickle.dumps(customer))
+        return customer
+
+    return wrapper
+
+
+def xdist_worker_index() -> int:
+    """Index of the current pytest-xdist worker, 0 when not running under xdist."""
+    worker = os.environ.get("PYTEST_XDIST_WORKER", "gw0")
+    return int(worker.removeprefix("gw"))
+
+
+def wait_for_port(port: int, timeout: float = 10.0) -> None:
+    """Block until something accepts TCP connections on localhost:port."""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with socket.create_connection(("localhost", port), timeout=0.5):
+                return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+class InMemoryRedis:
+    """Minimal stand-in for the subset of the Redis API used by the cache module."""
+
+    def __init__(self):
+        self.store = {}
+
+    def get(self, key):
+        return self.store.get(key)
+
+    def set(self, key, value, ex=None):
+        self.store[key] = value
+
+    def delete(self, *keys):
+        for key in keys:
+            self.store.pop(key, None)
+
+
+class CustomerSnapshot(NamedTuple):
+    """The persistent customer as created and as returned by each read path."""
+
+    expected: dict
+    by_id: stripe.Customer
+    by_email: stripe.ListObject
+    listed: stripe.ListObject
 
 
 #########################
@@ -28,12 +189,20 @@ def generate_unique_company_name() -> str:
 #########################
 
 
+@pytest.fixture(scope="session")
+def live_stripe(request) -> bool:
+    """Whether the suite runs against the real Stripe test API (--live-stripe)."""
+    return request.config.getoption("--live-stripe")
+
+
 @pytest.fixture(scope="session")
 def test_api_key():
     """
-    Fixture to get the Stripe test API key from environment variables.
+    Fixture to get the Stripe test API key from environment variables or a .env file.
     Skips all tests if the key is not set.
     """
+    # Only requested with --live-stripe, stripe-mock runs never read .env
+    load_dotenv(override=False)
     key = os.environ.get("STRIPE_TEST_API_KEY")
     if not key:
         pytest.skip("STRIPE_TEST_API_KEY environment variable not set")
@@ -41,17 +210,72 @@ def test_api_key():
 
 
 @pytest.fixture(scope="session")
-def stripe_client(test_api_key):
-    """Session-scoped fixture to create a single StripeClient."""
-    return StripeClient(api_key=test_api_key)
+def stripe_mock():
+    """
+    Provide the base URL of a local stripe-mock server.
+    Uses STRIPE_MOCK_URL when set (e.g. a CI service container), otherwise starts stripe-mock.
+    """
+    url = os.environ.get("STRIPE_MOCK_URL")
+    if url:
+        yield url
+        return
+
+    binary = shutil.which("stripe-mock")
+    if not binary:
+        pytest.skip("stripe-mock is not installed and STRIPE_MOCK_URL is not set")
+
+    # Every xdist worker starts its own server, so give each one its own port
+    port = STRIPE_MOCK_PORT + xdist_worker_index()
+    process = subprocess.Popen([binary, "-http-port", str(port)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port(port)
+        yield f"http://localhost:{port}"
+    finally:
+        process.terminate()
+        process.wait()
 
 
 @pytest.fixture(scope="session")
-def persistent_customer(stripe_client):
+def http_session(request):
     """
-    Creates a single "persistent" test customer once per test session.
-    This customer is deleted after all tests have completed.
+    HTTP session shared by every test in the session (one per xdist worker), so keep-alive connections are reused.
+    With --use-requests-cache GET responses are stored on disk and replayed on later runs.
     """
+    if request.config.getoption("--use-requests-cache"):
+        requests_cache = pytest.importorskip("requests_cache")
+        # Only reads are replayed, the API key never becomes part of the cache key or the stored request
+        session = requests_cache.CachedSession(
+            REQUESTS_CACHE_PATH,
+            backend="sqlite",
+            expire_after=REQUESTS_CACHE_EXPIRE_SECONDS,
+            allowable_methods=("GET",),
+            match_headers=False,
+            ignored_parameters=["Authorization"],
+        )
+    else:
+        session = requests.Session()
+
+    # Sized for the concurrent deletes of customer_janitor, stripe-mock is served over plain http
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    yield session
+    session.close()
+
+
+@pytest.fixture(scope="session")
+def stripe_client(request, live_stripe, http_session):
+    """Session-scoped fixture to create a single StripeClient, backed by stripe-mock unless --live-stripe."""
+    if live_stripe:
+        return StripeClient(api_key=request.getfixturevalue("test_api_key"), http_session=http_session)
+    return StripeClient(
+        api_key="sk_test_123", api_base=request.getfixturevalue("stripe_mock"), http_session=http_session
+    )
+
+
+@debug_caching
+def create_persistent_customer(stripe_client) -> dict:
+    """Create the customer shared by the read-only tests and return the fields they check."""
     customer_data = {
         "email": generate_unique_email(),
         "company_name": "dummy_company",
@@ -65,58 +289,136 @@ def persistent_customer(stripe_client):
             "state": "CA",
         },
     }
-    # Create the persistent customer
     customer = stripe_client.create_customer(**customer_data)
-
-    yield {
+    return {
         "id": customer.id,
         "email": customer.email,
         "name": customer.name,
         "phone": customer.phone,
     }
 
+
+@pytest.fixture(scope="session")
+def debug_cache_path(pytestconfig) -> Optional[Path]:
+    """Where the persistent customer is pickled with STRIPE_DEBUG_CACHE=1, None when debug caching is off."""
+    # config.cache is missing when the cacheprovider plugin is disabled
+    if not debug_cache_enabled() or getattr(pytestconfig, "cache", None) is None:
+        return None
+    return pytestconfig.cache.mkdir(DEBUG_CACHE_DIR) / DEBUG_CACHE_FILE
+
+
+@pytest.fixture(scope="session")
+def persistent_customer(stripe_client, http_session, debug_cache_path, tmp_path_factory):
+    """
+    Creates a single "persistent" test customer once per test session.
+    This customer is deleted after all tests have completed.
+
+    Under pytest-xdist the first worker to get here creates the customer and every other worker
+    reads it back from a file in the shared temp directory, the controller deletes it at session end.
+    With STRIPE_DEBUG_CACHE=1 the customer is never deleted and later runs reuse it instead.
+    """
+    if "PYTEST_XDIST_WORKER" in os.environ:
+        shared_file = tmp_path_factory.getbasetemp().parent / PERSISTENT_CUSTOMER_FILE
+        with FileLock(f"{shared_file}.lock"):
+            if shared_file.is_file():
+                customer = json.loads(shared_file.read_text())
+            else:
+                customer = create_persistent_customer(stripe_client, http_session, debug_cache_path)
+                shared_file.write_text(json.dumps(customer))
+        yield customer
+        return
+
+    customer = create_persistent_customer(stripe_client, http_session, debug_cache_path)
+    yield customer
+    if debug_cache_path is not None:
+        return
+
     # Teardown: delete the persistent customer once the entire session is finished
     try:
-        stripe_client.delete_customer(customer.id)
+        stripe_client.delete_customer(customer["id"])
     except Exception as e:
-        print(f"Warning: Failed to delete persistent test customer {customer.id}: {e}")
+        print(f"Warning: Failed to delete persistent test customer {customer['id']}: {e}")
+
+
+@pytest.fixture(scope="session")
+def customer_reads(persistent_customer, stripe_client) -> CustomerSnapshot:
+    """
+    Read the persistent customer back through every lookup once, so assertions on it need no requests.
+    The lookups are independent and run concurrently.
+    """
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        by_id = executor.submit(stripe_client.get_customer_by_id, persistent_customer["id"])
+        by_email = executor.submit(stripe_client.get_customers_by_email, persistent_customer["email"])
+        listed = executor.submit(stripe_client.list_customers, limit=LIST_PAGE_SIZE)
+
+    return CustomerSnapshot(
+        expected=persistent_customer, by_id=by_id.result(), by_email=by_email.result(), listed=listed.result()
+    )
 
 
 #########################
-# Function-Scoped Fixtures
+# Module-Scoped Fixtures
 #########################
 
 
-@pytest.fixture
+@pytest.fixture(scope="module")
 def test_customer_data():
-    """Fixture to provide test customer data with a unique email."""
+    """Fixture to provide test customer data with a unique email, shared by the module so treat it as read-only."""
     return {
         "email": generate_unique_email(),
         "company_name": "Test Company",
         "phone": "+15555555555",
-        "address": {
-            "city": "San Francisco",
-            "country": "US",
-            "street1": "123 Market St",
-            "street2": "Suite 456",
-            "zipCode": "94107",
-            "state": "CA",
-        },
+        "address": dict(ADDR_INPUT),
     }
 
 
-@pytest.fixture
-def created_customer(stripe_client, test_customer_data):
+@pytest.fixture(scope="module")
+def customer_janitor(stripe_client):
     """
-    Fixture to create a short-lived test customer for each test.
-    The customer is cleaned up after the test finishes.
+    Collects the IDs of customers created by the module's tests.
+    They are deleted concurrently once the module finishes instead of one request per test.
+    """
+    customer_ids = []
+    yield customer_ids
+
+    def delete(customer_id):
+        try:
+            stripe_client.delete_customer(customer_id)
+        except Exception as e:
+            print(f"Warning: Failed to delete test customer {customer_id}: {e}")
+
+    # Test mode accounts allow far fewer requests per second than live mode
+    stripe_client.bulk(delete, customer_ids, max_concurrency=8, max_per_second=20)
+
+
+@pytest.fixture(scope="module")
+def created_customer(stripe_client, test_customer_data, customer_janitor):
+    """
+    Fixture to create a test customer once per module.
+    The customer is cleaned up by customer_janitor after the module finishes.
     """
     customer = stripe_client.create_customer(**test_customer_data)
-    yield customer
-    try:
-        stripe_client.delete_customer(customer.id)
-    except Exception as e:
-        print(f"Warning: Failed to delete test customer {customer.id}: {e}")
+    customer_janitor.append(customer.id)
+    return customer
+
+
+#########################
+# Function-Scoped Fixtures
+#########################
+
+
+@pytest.fixture
+def fresh_api_key_cache():
+    """Start with nothing resolved from STRIPE_API_KEY and forget what the test resolved, even if it fails."""
+    _resolve_api_key.cache_clear()
+    yield
+    _resolve_api_key.cache_clear()
+
+
+@pytest.fixture
+def fresh_customer_view(created_customer):
+    """Deep copy of the module customer so assertions are not affected by other tests."""
+    return copy.deepcopy(created_customer)
 
 
 #########################
@@ -127,24 +429,563 @@ def created_customer(stripe_client, test_customer_data):
 class TestStripeUtils:
     """Tests for the utility functions outside the StripeClient class."""
 
-    def test_format_address(self, test_customer_data):
-        """Test that addresses are correctly formatted for Stripe."""
-        address = test_customer_data["address"]
-        formatted_address = format_address(address)
+    @pytest.mark.parametrize(
+        "inp,expected",
+        [
+            pytest.param(ADDR_INPUT, ADDR_EXPECTED, id="application_format"),
+            pytest.param(
+                {"line1": "123 Market St", "postal_code": "94107", "city": "San Francisco", "state": ""},
+                {"line1": "123 Market St", "postal_code": "94107", "city": "San Francisco"},
+                id="stripe_format",
+            ),
+            pytest.param(
+                {"city": "San Francisco", "zipCode": 94107},
+                {"city": "San Francisco", "postal_code": "94107"},
+                id="numeric_zip_code",
+            ),
+            pytest.param(
+                {"city": "San Francisco", "state": False, "zipCode": 0},
+                {"city": "San Francisco"},
+                id="falsy_values",
+            ),
+            pytest.param(None, None, id="none"),
+            pytest.param({}, None, id="empty"),
+            pytest.param({"city": "", "street1": None}, None, id="blank_fields"),
+        ],
+    )
+    def test_format_address(self, inp, expected):
+        """Test that addresses are correctly formatted for Stripe, empty addresses format to None."""
+        formatted_address = format_address(inp)
 
-        assert formatted_address == {
-            "city": "San Francisco",
-            "country": "US",
-            "line1": "123 Market St",
-            "line2": "Suite 456",
-            "postal_code": "94107",
-            "state": "CA",
+        assert (formatted_address.to_dict() if formatted_address is not None else None) == expected
+
+    def test_email_query_escapes_quotes(self):
+        """Test that emails cannot break out of the quoted search value."""
+        assert _email_query("a@example.com") == "email:'a@example.com'"
+        assert _email_query("o'neil\\@example.com") == "email:'o\\'neil\\\\@example.com'"
+
+    def test_response_serializes_stripe_objects(self):
+        """Test that responses carrying Stripe objects serialize to JSON bytes."""
+        customer = stripe.Customer.construct_from({"id": "cus_json", "object": "customer"}, "sk_test_json")
+        response = CustomerApiResponse(success=True, message="ok", data=customer, status_code=201)
+
+        body, status_code, headers = response.to_http_response()
+
+        assert body == b'{"success":true,"message":"ok","data":{"id":"cus_json","object":"customer"}}'
+        assert status_code == 201
+        assert headers == {"Content-Type": "application/json"}
+
+
+#########################
+# Offline Client Tests
+#########################
+
+
+class FakeClock:
+    """Clock whose sleeps advance time instantly, patched over the rate limiters' time and asyncio."""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.now += seconds
+
+    async def async_sleep(self, seconds: float) -> None:
+        self.now += seconds
+
+
+@pytest.fixture
+def fake_clock(monkeypatch: pytest.MonkeyPatch) -> FakeClock:
+    clock = FakeClock()
+    monkeypatch.setattr(concurrency, "time", SimpleNamespace(monotonic=clock.monotonic, sleep=clock.sleep))
+    monkeypatch.setattr(concurrency, "asyncio", SimpleNamespace(sleep=clock.async_sleep))
+    return clock
+
+
+class FakeAsyncCustomers:
+    """Async customer endpoints backed by a list, patched over the service class the async client uses."""
+
+    API_KEY = "sk_test_async_handlers"
+
+    def __init__(self):
+        self.customers: list[dict] = []
+        self.calls: list[tuple] = []
+        self.error: Optional[stripe.StripeError] = None
+
+    async def list_async(self, params=None, options=None):
+        self.calls.append(("list", params["email"]))
+        if self.error is not None:
+            raise self.error
+        data = [customer for customer in self.customers if customer["email"] == params["email"]]
+        return stripe.ListObject.construct_from(
+            {"object": "list", "url": "/v1/customers", "data": data, "has_more": False}, self.API_KEY
+        )
+
+    async def create_async(self, params=None, options=None):
+        self.calls.append(("create", params["email"]))
+        return stripe.Customer.construct_from({"id": "cus_created", "object": "customer", **params}, self.API_KEY)
+
+    async def delete_async(self, customer, params=None, options=None):
+        self.calls.append(("delete", customer))
+        return stripe.Customer.construct_from({"id": customer, "object": "customer", "deleted": True}, self.API_KEY)
+
+
+@pytest.fixture
+def async_customers(monkeypatch: pytest.MonkeyPatch) -> FakeAsyncCustomers:
+    monkeypatch.setattr(cache, "_redis_client", InMemoryRedis())
+    fake = FakeAsyncCustomers()
+
+    def endpoint(method):
+        async def call(service, *args, **kwargs):
+            return await method(*args, **kwargs)
+
+        return call
+
+    for name in ("list_async", "create_async", "delete_async"):
+        monkeypatch.setattr(stripe.CustomerService, name, endpoint(getattr(fake, name)))
+    return fake
+
+
+class TestStripeClientOffline:
+    """Tests for the clients, handlers and their helpers that need neither Stripe nor stripe-mock."""
+
+    def test_client_is_shared_per_api_key(self):
+        """Test that clients for the same API key reuse one underlying stripe client."""
+        first = StripeClient(api_key="sk_test_shared")
+        second = StripeClient(api_key="sk_test_shared")
+        other = StripeClient(api_key="sk_test_other")
+
+        assert first.stripe is second.stripe
+        assert first.stripe is not other.stripe
+
+    def test_client_uses_given_http_session(self):
+        """Test that a caller supplied session is used and not shared through the client cache."""
+        session = requests.Session()
+        client = StripeClient(api_key="sk_test_shared", http_session=session)
+
+        assert client.stripe is not StripeClient(api_key="sk_test_shared").stripe
+        assert client.stripe._requestor._client._session is session
+
+    def test_api_key_resolved_from_environment(self, monkeypatch, fresh_api_key_cache):
+        """Test that the API key falls back to STRIPE_API_KEY and is read once."""
+        monkeypatch.delenv("STRIPE_API_KEY", raising=False)
+        with pytest.raises(StripeError):
+            StripeClient()
+
+        monkeypatch.setenv("STRIPE_API_KEY", "sk_test_from_env")
+        assert StripeClient().api_key == "sk_test_from_env"
+
+        monkeypatch.setenv("STRIPE_API_KEY", "sk_test_changed")
+        assert StripeClient().api_key == "sk_test_from_env"
+
+    def test_get_customer_by_id_uses_cache(self, monkeypatch):
+        """Test that a cached customer is returned without calling Stripe."""
+        monkeypatch.setattr(cache, "_redis_client", InMemoryRedis())
+        client = StripeClient(api_key="sk_test_cache")
+        cache.set_generic_cache(
+            _customer_cache_key(client._cache_namespace, "cus_cached"),
+            {"id": "cus_cached", "object": "customer", "email": "a@example.com"},
+            60,
+        )
+
+        customer = client.get_customer_by_id("cus_cached")
+
+        assert customer.id == "cus_cached"
+        assert customer.email == "a@example.com"
+
+    def test_cache_is_namespaced_per_api_key(self):
+        """Test that clients for different keys or API bases never share cache entries."""
+        assert _cache_namespace("sk_test_a") != _cache_namespace("sk_live_a")
+        assert _cache_namespace("sk_test_a") != _cache_namespace("sk_test_a", "http://localhost:12111")
+        assert "sk_test_a" not in _customer_cache_key(_cache_namespace("sk_test_a"), "cus_1")
+
+    @pytest.mark.parametrize(
+        "handler,data",
+        [
+            pytest.param(delete_customer_by_email_function, {"email": "deleted@example.com"}, id="single"),
+            pytest.param(delete_customers_by_emails_function, {"emails": ["deleted@example.com"]}, id="bulk"),
+        ],
+    )
+    def test_delete_by_email_clears_email_caches(self, monkeypatch, handler, data):
+        """Test that deleting by email drops the cached lookup and the exists flag, so the email can be reused."""
+        monkeypatch.setattr(cache, "_redis_client", InMemoryRedis())
+        api_key = "sk_test_delete_cache"
+        client = StripeClient(api_key=api_key)
+        email = "deleted@example.com"
+        page = {"data": [{"id": "cus_deleted", "object": "customer", "email": email}], "has_more": False}
+        customers = client.stripe.customers
+        monkeypatch.setattr(
+            customers,
+            "list",
+            lambda params: stripe.ListObject.construct_from(
+                {"object": "list", "url": "/v1/customers", **page}, api_key
+            ),
+        )
+        monkeypatch.setattr(
+            customers,
+            "search",
+            lambda params: stripe.SearchResultObject.construct_from(
+                {"object": "search_result", "url": "/v1/customers/search", **page}, api_key
+            ),
+        )
+        monkeypatch.setattr(
+            customers,
+            "delete",
+            lambda customer_id: stripe.Customer.construct_from(
+                {"id": customer_id, "object": "customer", "deleted": True}, api_key
+            ),
+        )
+        cache.set_generic_cache(_email_seen_cache_key(client._cache_namespace, email), True, 60)
+
+        assert handler(data, api_key=api_key).status_code == 200
+        assert cache.get_generic_cache(_customer_email_cache_key(client._cache_namespace, email)) is None
+        assert cache.get_generic_cache(_email_seen_cache_key(client._cache_namespace, email)) is None
+
+    def test_email_change_frees_the_old_email(self, monkeypatch):
+        """Test that after changing a customer's email the old email can be used for a new customer."""
+        monkeypatch.setattr(cache, "_redis_client", InMemoryRedis())
+        api_key = "sk_test_email_change"
+        client = StripeClient(api_key=api_key)
+        old_email, new_email = "old@example.com", "new@example.com"
+
+        def customer(email, customer_id="cus_1"):
+            return stripe.Customer.construct_from({"id": customer_id, "object": "customer", "email": email}, api_key)
+
+        customers = client.stripe.customers
+        monkeypatch.setattr(customers, "retrieve", lambda customer_id: customer(old_email))
+        monkeypatch.setattr(customers, "update", lambda customer_id, params: customer(params["email"]))
+        monkeypatch.setattr(
+            customers,
+            "list",
+            lambda params: stripe.ListObject.construct_from(
+                {"object": "list", "url": "/v1/customers", "data": [], "has_more": False}, api_key
+            ),
+        )
+        monkeypatch.setattr(customers, "create", lambda params, options: customer(params["email"], "cus_2"))
+        cache.set_generic_cache(_email_seen_cache_key(client._cache_namespace, old_email), True, 60)
+
+        client.update_customer("cus_1", {"email": new_email})
+        response = create_customer_function(
+            {"email": old_email, "company_name": "Test Company", "phone": "+15555555555"}, api_key=api_key
+        )
+
+        assert response.status_code == 201
+        assert cache.get_generic_cache(_customer_email_cache_key(client._cache_namespace, old_email)) is None
+
+    def test_delete_by_email_not_found(self, monkeypatch):
+        """Test that deleting an email with no customer returns 404 without deleting anything."""
+        api_key = "sk_test_delete_not_found"
+        customers = StripeClient(api_key=api_key).stripe.customers
+        monkeypatch.setattr(
+            customers,
+            "list",
+            lambda params: stripe.ListObject.construct_from(
+                {"object": "list", "url": "/v1/customers", "data": [], "has_more": False}, api_key
+            ),
+        )
+        monkeypatch.setattr(customers, "delete", lambda customer_id: pytest.fail("nothing should be deleted"))
+
+        response = delete_customer_by_email_function({"email": "missing@example.com"}, api_key=api_key)
+
+        assert response.status_code == 404
+        assert not response.success
+
+    @pytest.mark.parametrize(
+        "emails",
+        [None, [], "a@example.com", ["a@example.com", ""], ["a@example.com", None], {"a@example.com": 1}],
+        ids=["missing", "empty", "string", "blank_email", "none_email", "dict"],
+    )
+    def test_bulk_delete_requires_list_of_emails(self, emails):
+        """Test that anything but a list of non-empty strings is rejected before searching Stripe."""
+        response = delete_customers_by_emails_function({"emails": emails}, api_key="sk_test_emails_required")
+
+        assert response is EMAILS_REQUIRED_RESPONSE
+
+    def test_redis_connection_times_out(self, monkeypatch):
+        """Test that the cache connection is configured to fail fast when Redis is unreachable."""
+        monkeypatch.setattr(cache, "_redis_client", None)
+        monkeypatch.setenv(cache.REDIS_URL_ENV_VAR, "redis://localhost:6379")
+
+        connection_kwargs = cache._get_redis().connection_pool.connection_kwargs
+
+        assert connection_kwargs["socket_timeout"] == cache.REDIS_SOCKET_TIMEOUT
+        assert connection_kwargs["socket_connect_timeout"] == cache.REDIS_SOCKET_TIMEOUT
+
+    def test_async_cache_writes_leave_the_event_loop(self, monkeypatch):
+        """Test that the async client runs its blocking cache invalidation in a worker thread."""
+        threads = []
+        monkeypatch.setattr(
+            async_client, "_invalidate_customer_cache", lambda *args: threads.append(threading.current_thread())
+        )
+
+        async def delete_customer(self, customer_id):
+            return stripe.Customer.construct_from({"id": customer_id, "deleted": True}, "sk_test_async_cache")
+
+        monkeypatch.setattr(stripe.CustomerService, "delete_async", delete_customer)
+
+        asyncio.run(AsyncStripeClient(api_key="sk_test_async_cache").delete_customer("cus_1", email="a@example.com"))
+
+        assert threads and threads[0] is not threading.main_thread()
+
+    @pytest.mark.parametrize("exists", [False, True], ids=["new", "exists"])
+    def test_async_create_customer_function(self, async_customers, exists):
+        """Test that the async create handler creates new customers and rejects taken emails."""
+        email = "async@example.com"
+        if exists:
+            async_customers.customers.append({"id": "cus_existing", "object": "customer", "email": email})
+        data = {"email": email, "company_name": "Test Company", "phone": "+15555555555"}
+
+        response = asyncio.run(create_customer_function_async(data, api_key=FakeAsyncCustomers.API_KEY))
+
+        if exists:
+            assert response.status_code == 400
+            assert response.error_code == "CUSTOMER_EXISTS"
+            assert async_customers.calls == [("list", email)]
+        else:
+            assert response.status_code == 201
+            assert response.data.id == "cus_created"
+            assert async_customers.calls == [("list", email), ("create", email)]
+
+    @pytest.mark.parametrize("found", [True, False], ids=["found", "not_found"])
+    def test_async_delete_customer_by_email_function(self, async_customers, found):
+        """Test that the async delete handler deletes the matching customer and returns 404 when there is none."""
+        email = "async@example.com"
+        if found:
+            async_customers.customers.append({"id": "cus_async", "object": "customer", "email": email})
+
+        response = asyncio.run(
+            delete_customer_by_email_function_async({"email": email}, api_key=FakeAsyncCustomers.API_KEY)
+        )
+
+        if found:
+            assert response.status_code == 200
+            assert async_customers.calls == [("list", email), ("delete", "cus_async")]
+        else:
+            assert response.status_code == 404
+            assert async_customers.calls == [("list", email)]
+
+    @pytest.mark.parametrize(
+        "handler", [create_customer_function_async, delete_customer_by_email_function_async], ids=["create", "delete"]
+    )
+    def test_async_handlers_report_stripe_errors(self, async_customers, handler):
+        """Test that Stripe failures in the async handlers become STRIPE_ERROR responses."""
+        async_customers.error = stripe.InvalidRequestError("bad request", param=None)
+        data = {"email": "async@example.com", "company_name": "Test Company", "phone": "+15555555555"}
+
+        response = asyncio.run(handler(data, api_key=FakeAsyncCustomers.API_KEY))
+
+        assert response.status_code == 500
+        assert response.error_code == "STRIPE_ERROR"
+
+    def test_async_clients_share_one_pool_per_loop(self):
+        """Test that async clients reuse one connection pool per event loop and that it can be closed."""
+
+        async def pool():
+            return AsyncStripeClient(api_key="sk_test_pool").stripe._requestor._client._client_async
+
+        async def run_loop():
+            first = await pool()
+            assert await pool() is first
+            await close_http_client()
+            assert first.is_closed
+            return first
+
+        assert asyncio.run(run_loop()) is not asyncio.run(run_loop())
+
+    def test_async_pool_is_released_when_the_loop_ends(self):
+        """Test that a loop's connection pool is closed and dropped by asyncio.run without an explicit close."""
+
+        async def run_loop():
+            return AsyncStripeClient(api_key="sk_test_pool").stripe._requestor._client._client_async
+
+        pool = asyncio.run(run_loop())
+
+        assert pool.is_closed
+        assert not async_client._get_http_client()._pools
+
+    def test_bulk_preserves_order(self):
+        """Test that bulk returns results in the order of its inputs."""
+        client = StripeClient(api_key="sk_test_bulk")
+
+        assert client.bulk(lambda n: n * 2, range(10), max_concurrency=4, max_per_second=1000) == [
+            n * 2 for n in range(10)
+        ]
+
+    def test_async_bulk_preserves_order(self):
+        """Test that async bulk returns results in the order of its inputs."""
+
+        async def double(n: int) -> int:
+            await asyncio.sleep(0.001 * (10 - n))
+            return n * 2
+
+        client = AsyncStripeClient(api_key="sk_test_bulk")
+        results = asyncio.run(client.bulk(double, range(10), max_concurrency=4, max_per_second=1000))
+
+        assert results == [n * 2 for n in range(10)]
+
+    def test_async_bulk_cancels_the_rest_on_failure(self):
+        """Test that async bulk cancels pending calls and raises the first error unwrapped."""
+        finished = []
+
+        async def call(n: int) -> int:
+            if n == 1:
+                raise StripeError("failed")
+            await asyncio.sleep(10)
+            finished.append(n)
+            return n
+
+        client = AsyncStripeClient(api_key="sk_test_bulk")
+        with pytest.raises(StripeError, match="failed"):
+            asyncio.run(client.bulk(call, range(4), max_concurrency=4, max_per_second=1000))
+
+        assert finished == []
+
+    def test_rate_limiter_spaces_calls(self, fake_clock: "FakeClock"):
+        """Test that the thread limiter starts calls one interval apart."""
+        limiter = concurrency.RateLimiter(max_per_second=10)
+
+        starts = []
+        for _ in range(3):
+            limiter.acquire()
+            starts.append(fake_clock.now)
+
+        assert starts == pytest.approx([0, 0.1, 0.2])
+
+    def test_async_rate_limiter_spaces_calls(self, fake_clock: "FakeClock"):
+        """Test that the event loop limiter starts concurrent calls one interval apart."""
+        limiter = concurrency.AsyncRateLimiter(max_per_second=10)
+        starts = []
+
+        async def call():
+            await limiter.acquire()
+            starts.append(fake_clock.now)
+
+        async def run_calls():
+            await asyncio.gather(*(call() for _ in range(3)))
+
+        asyncio.run(run_calls())
+
+        assert sorted(starts) == pytest.approx([0, 0.1, 0.2])
+
+    def test_concurrent_lookups_are_coalesced(self):
+        """Test that identical concurrent lookups share a single request."""
+        calls = []
+
+        async def fetch():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return "customer"
+
+        async def run():
+            return await asyncio.gather(*(_coalesce(("sk_test", "email", "a@example.com"), fetch) for _ in range(5)))
+
+        assert asyncio.run(run()) == ["customer"] * 5
+        assert len(calls) == 1
+
+    def test_retry_on_rate_limit(self, monkeypatch):
+        """Test that rate limited calls are retried and other errors are not."""
+        monkeypatch.setattr(time, "sleep", lambda seconds: None)
+        calls = []
+
+        @retry_stripe_call
+        def flaky(error):
+            calls.append(error)
+            if len(calls) < 3:
+                raise StripeError("failed", error)
+            return "ok"
+
+        assert flaky(stripe.RateLimitError("slow down")) == "ok"
+        assert len(calls) == 3
+
+        calls.clear()
+        with pytest.raises(StripeError):
+            flaky(stripe.InvalidRequestError("bad request", param=None))
+        assert len(calls) == 1
+
+    def test_retried_create_reuses_idempotency_key(self, monkeypatch):
+        """Test that a create retried after a connection error resends its key and a given key is passed through."""
+        monkeypatch.setattr(cache, "_redis_client", InMemoryRedis())
+        monkeypatch.setattr(time, "sleep", lambda seconds: None)
+        api_key = "sk_test_idempotency"
+        client = StripeClient(api_key=api_key)
+        keys = []
+
+        def create(params, options):
+            keys.append(options["idempotency_key"])
+            if len(keys) == 1:
+                raise stripe.APIConnectionError("connection reset")
+            return stripe.Customer.construct_from({"id": "cus_1", "object": "customer", **params}, api_key)
+
+        monkeypatch.setattr(client.stripe.customers, "create", create)
+
+        client.create_customer("retry@example.com", "Test Company", "+15555555555")
+        assert len(keys) == 2
+        assert keys[0] == keys[1]
+
+        keys.clear()
+        client.create_customer("given@example.com", "Test Company", "+15555555555", idempotency_key="create-given")
+        assert keys == ["create-given", "create-given"]
+
+    def test_iter_customers_by_email_fetches_pages_lazily(self):
+        """Test that the next search page is only requested once the previous one is consumed."""
+        email = "paged@example.com"
+        pages = {
+            None: {"data": [{"id": "cus_1", "email": email}], "has_more": True, "next_page": "page_2"},
+            "page_2": {"data": [{"id": "cus_2", "email": email}], "has_more": False, "next_page": None},
         }
 
-    def test_format_address_empty(self):
-        """Test formatting an empty address."""
-        assert format_address(None) == {}
-        assert format_address({}) == {}
+        class PagedSession:
+            def __init__(self):
+                self.urls = []
+
+            def request(self, method, url, **kwargs):
+                self.urls.append(url)
+                page = pages[dict(parse_qsl(urlsplit(url).query)).get("page")]
+                data = [{"object": "customer", **customer} for customer in page["data"]]
+                body = {"object": "search_result", "url": "/v1/customers/search", **page, "data": data}
+                return SimpleNamespace(content=json.dumps(body).encode(), status_code=200, headers={})
+
+        session = PagedSession()
+        customers = StripeClient(api_key="sk_test_paged", http_session=session).iter_customers_by_email(email)
+
+        assert session.urls == []
+        assert next(customers).id == "cus_1"
+        assert len(session.urls) == 1
+        assert [customer.id for customer in customers] == ["cus_2"]
+        assert len(session.urls) == 2
+        assert "page=page_2" in session.urls[1]
+
+    def test_get_customers_by_emails_retries_per_chunk(self, monkeypatch):
+        """Test that a failed chunk is retried alone and duplicate emails return each customer once."""
+        monkeypatch.setattr(time, "sleep", lambda seconds: None)
+        api_key = "sk_test_emails"
+        client = StripeClient(api_key=api_key)
+        queries = []
+
+        def search(params):
+            queries.append(params["query"])
+            if len(queries) == 2:
+                raise stripe.RateLimitError("slow down")
+            data = [
+                {"id": f"cus_{email}", "object": "customer", "email": email}
+                for email in re.findall(r"email:'([^']*)'", params["query"])
+            ]
+            return stripe.SearchResultObject.construct_from(
+                {"object": "search_result", "url": "/v1/customers/search", "data": data, "has_more": False}, api_key
+            )
+
+        monkeypatch.setattr(client.stripe.customers, "search", search)
+        emails = [f"user{i}@example.com" for i in range(SEARCH_EMAILS_PER_QUERY + 1)]
+
+        customers = client.get_customers_by_emails(emails + emails[:2])
+
+        assert [c.email for c in customers] == emails
+        # The second chunk failed once and was retried without searching the first chunk again
+        assert len(queries) == 3
+        assert queries[1] == queries[2] != queries[0]
 
 
 #########################
@@ -152,80 +993,66 @@ class TestStripeUtils:
 #########################
 
 
+@pytest.mark.slow
 class TestStripeClient:
     """Tests for the StripeClient class methods."""
 
-    def test_create_customer(self, stripe_client, test_customer_data):
+    def test_create_customer(self, stripe_client, test_customer_data, customer_janitor):
         """Test customer creation."""
         try:
             customer = stripe_client.create_customer(**test_customer_data)
-
-            # Verify the customer was created successfully
-            assert customer.id is not None
-            assert customer.email == test_customer_data["email"]
-            assert customer.name == test_customer_data["company_name"]
-            assert customer.phone == test_customer_data["phone"]
-
-            # Clean up
-            stripe_client.delete_customer(customer.id)
         except StripeError as e:
             pytest.fail(f"Failed to create customer: {e}")
+        customer_janitor.append(customer.id)
 
-    def test_get_customer_by_id(self, stripe_client, persistent_customer):
-        """
-        Test retrieving a customer by ID using the persistent customer.
-        This test doesn't create a new customer, using the persistent one instead.
-        """
-        customer = stripe_client.get_customer_by_id(persistent_customer["id"])
-
-        assert customer.id == persistent_customer["id"]
-        assert customer.email == persistent_customer["email"]
-        assert customer.name == persistent_customer["name"]
-
-    def test_get_customers_by_email(self, stripe_client, persistent_customer):
-        """
-        Test retrieving customers by email using the persistent customer.
-        """
-        # Search for the customer by email
-        email = persistent_customer["email"]
-        search_result = stripe_client.get_customers_by_email(email)
-
-        # Verify we got a list of results
-        assert search_result is not None
-        assert hasattr(search_result, "data")
-        assert isinstance(search_result["data"], list)
-
-        first_result = search_result["data"][0]
-        assert first_result["id"] == persistent_customer["id"]
+        # Verify the customer was created successfully
+        assert customer.id is not None
+        assert customer.email == test_customer_data["email"]
+        assert customer.name == test_customer_data["company_name"]
+        assert customer.phone == test_customer_data["phone"]
 
-    def test_update_customer(self, stripe_client, created_customer):
+    def test_update_customer(self, stripe_client, fresh_customer_view, live_stripe):
         """Test updating a customer"""
         new_company_name = "Updated Test Company"
         new_phone = "+15551234567"
 
         updated_customer = stripe_client.update_customer(
-            created_customer.id, {"name": new_company_name, "phone": new_phone}
+            fresh_customer_view.id, {"name": new_company_name, "phone": new_phone}
         )
 
         # Verify the update was successful
-        assert updated_customer.id == created_customer.id
+        assert updated_customer.id == fresh_customer_view.id
         assert updated_customer.name == new_company_name
         assert updated_customer.phone == new_phone
-        # Email should remain unchanged
-        assert updated_customer.email == created_customer.email
+        # Email should remain unchanged, stripe-mock only echoes the params sent so it cannot show this
+        if live_stripe:
+            assert updated_customer.email == fresh_customer_view.email
 
-    def test_list_customers(self, stripe_client, persistent_customer):
+    @pytest.mark.live_stripe
+    def test_list_customers(self, customer_reads):
         """
-        Test listing customers with pagination using the persistent customer.
-        Ensures our persistent customer appears in the list.
+        Test listing customers with pagination.
+        The persistent customer guarantees the page is not empty.
         """
-        customers_page = stripe_client.list_customers(limit=100)
+        customers_page = customer_reads.listed
         assert hasattr(customers_page, "data")
-        assert len(customers_page.data) > 0
+        assert 0 < len(customers_page.data) <= LIST_PAGE_SIZE
+        assert isinstance(customers_page.has_more, bool)
 
-        # Check if our persistent customer is in the results
-        customer_ids = [c.id for c in customers_page.data]
-        assert persistent_customer["id"] in customer_ids
+    @pytest.mark.live_stripe
+    @pytest.mark.parametrize(
+        "check",
+        [
+            pytest.param(lambda snap: snap.by_id.id == snap.expected["id"], id="id_matches"),
+            pytest.param(lambda snap: snap.by_id.email == snap.expected["email"], id="email_matches"),
+            pytest.param(lambda snap: snap.by_id.name == snap.expected["name"], id="name_matches"),
+            pytest.param(lambda snap: isinstance(snap.by_email.data, list), id="email_lookup_is_list"),
+            pytest.param(lambda snap: snap.by_email.data[0].id == snap.expected["id"], id="found_by_email"),
+        ],
+    )
+    def test_customer_snapshot(self, customer_reads, check):
+        """Test that every read path returns the persistent customer."""
+        assert check(customer_reads)
 
     def test_delete_customer(self, stripe_client, test_customer_data):
         """Test deleting a customer."""
@@ -240,13 +1067,21 @@ class TestStripeClient:
         assert result.deleted is True
         assert result.id == customer.id
 
+    @pytest.mark.live_stripe
     def test_customer_not_found(self, stripe_client):
-        """Test error handling for non-existent customer."""
-        non_existent_id = "cus_nonexistent" + uuid.uuid4().hex[:16]
+        """Test that retrieving a non-existent customer returns None."""
+        non_existent_id = "cus_nonexistent" + token_hex(8)
+
+        assert stripe_client.get_customer_by_id(non_existent_id) is None
+
+    @pytest.mark.live_stripe
+    def test_delete_customer_not_found(self, stripe_client):
+        """Test error handling for deleting a non-existent customer."""
+        non_existent_id = "cus_nonexistent" + token_hex(8)
 
         with pytest.raises(StripeError) as excinfo:
-            stripe_client.get_customer_by_id(non_existent_id)
+            stripe_client.delete_customer(non_existent_id)
 
         # Verify the error message contains useful information
-        error_message = str(excinfo.value).lower()
-        assert "no such customer" in error_message or "could not be found" in error_message
+        assert _NOT_FOUND_RE.search(str(excinfo.value))
+        assert isinstance(excinfo.value.__cause__, stripe.InvalidRequestError)